@@ -12,8 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import glob
+from functools import lru_cache
 import numpy
 from nvidia.dali import pipeline_def
 import nvidia.dali.fn as fn
@@ -23,7 +25,6 @@ import os
 import random
 import tempfile
 import time
-from PIL import Image, ImageEnhance
 from nvidia.dali.ops import _DataNode
 from nvidia.dali.pipeline import Pipeline
 
@@ -45,7 +46,11 @@ def test_dlpack_conversions():
 
 
 def resize(image):
-    return numpy.array(Image.fromarray(image).resize((300, 300)))
+    return cv2.resize(image, (300, 300), interpolation=cv2.INTER_LINEAR)
+
+
+def resize_batch(images):
+    return [resize(image) for image in images]
 
 
 class CommonPipeline(Pipeline):
@@ -55,7 +60,8 @@ class CommonPipeline(Pipeline):
                          prefetch_queue_depth=prefetch_queue_depth)
         self.input = ops.readers.File(file_root=image_dir)
         self.decode = ops.decoders.Image(device='cpu', output_type=types.RGB)
-        self.resize = ops.PythonFunction(function=resize, output_layouts='HWC')
+        self.resize = ops.PythonFunction(function=resize_batch, batch_processing=True,
+                                         output_layouts='HWC')
 
     def load(self):
         jpegs, labels = self.input()
@@ -175,35 +181,51 @@ SEED = random_seed()
 NUM_WORKERS = 6
 
 
+# Reference pipelines are deterministic for the module's fixed seed, so each one is built and run
+# only once and the samples of all its iterations are shared by the tests that compare against it.
+# The price is memory: the samples stay alive until the process exits (about 35 MB for
+# BasicPipeline and 70 MB for DoubleLoadPipeline).
+@lru_cache(maxsize=None)
+def reference_outputs(pipeline_class):
+    pipe = pipeline_class(BATCH_SIZE, NUM_WORKERS, DEVICE_ID, SEED, images_dir)
+    pipe.build()
+    outputs = []
+    for it in range(ITERS):
+        outputs.append(tuple([out.at(i) for i in range(len(out))] for out in pipe.run()))
+    return outputs
+
+
+def batch_to_array(tensor_list):
+    return numpy.stack([tensor_list.at(i) for i in range(len(tensor_list))])
+
+
 def run_case(func):
-    pipe = BasicPipeline(BATCH_SIZE, NUM_WORKERS, DEVICE_ID, SEED, images_dir)
     pyfunc_pipe = PythonOperatorPipeline(BATCH_SIZE, NUM_WORKERS, DEVICE_ID, SEED, images_dir, func)
-    pipe.build()
     pyfunc_pipe.build()
-    for it in range(ITERS):
-        preprocessed_output, = pipe.run()
-        output, = pyfunc_pipe.run()
-        for i in range(len(output)):
-            assert numpy.array_equal(output.at(i), func(preprocessed_output.at(i)))
+    # The expected results are computed while the tested pipeline runs
+    with ThreadPoolExecutor(NUM_WORKERS) as ref_pool:
+        for inputs, in reference_outputs(BasicPipeline):
+            expected = ref_pool.map(func, inputs)
+            output, = pyfunc_pipe.run()
+            assert numpy.array_equal(batch_to_array(output), numpy.stack(list(expected)))
 
 
 def one_channel_normalize(image):
-    return image[:, :, 1] / 255.
+    return image[:, :, 1] * numpy.float32(1. / 255.)
 
 
 def channels_mean(image):
-    r = numpy.mean(image[:, :, 0])
-    g = numpy.mean(image[:, :, 1])
-    b = numpy.mean(image[:, :, 2])
-    return numpy.array([r, g, b])
+    return image.reshape(-1, image.shape[-1]).mean(axis=0, dtype=numpy.float64)
 
 
 def bias(image):
-    return numpy.array(image > 127, dtype=bool)
+    return numpy.greater(image, numpy.uint8(127))
 
 
 def flip(image):
-    return numpy.fliplr(image)
+    if image.ndim == 3 and image.shape[2] >= 3:
+        return cv2.flip(image, 1)
+    return numpy.ascontiguousarray(image[:, ::-1])
 
 
 def flip_batch(images):
@@ -222,11 +244,11 @@ def dlflip_batch(images):
 
 
 def Rotate(image):
-    return numpy.rot90(image)
+    return cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
 
 
 def Brightness(image):
-    return numpy.array(ImageEnhance.Brightness(Image.fromarray(image)).enhance(0.5))
+    return (image * numpy.float32(0.5) + numpy.float32(0.5)).astype(numpy.uint8)
 
 
 def test_python_operator_one_channel_normalize():
@@ -249,8 +271,11 @@ def test_python_operator_flip():
     for it in range(ITERS):
         numpy_output, = numpy_flip.run()
         dali_output, = dali_flip.run()
-        for i in range(len(numpy_output)):
-            assert numpy.array_equal(numpy_output.at(i), dali_output.at(i))
+        assert numpy.array_equal(batch_to_array(numpy_output), batch_to_array(dali_output))
+
+
+def test_python_operator_negative_stride_output():
+    run_case(numpy.fliplr)
 
 
 class RotatePipeline(CommonPipeline):
@@ -284,11 +309,18 @@ def test_python_operator_rotate():
     for it in range(ITERS):
         numpy_output, = numpy_rotate.run()
         dali_output, = dali_rotate.run()
-        for i in range(len(numpy_output)):
-            if not numpy.array_equal(numpy_output.at(i), dali_output.at(i)):
-                cv2.imwrite("numpy.png", numpy_output.at(i))
-                cv2.imwrite("dali.png", dali_output.at(i))
-                assert numpy.array_equal(numpy_output.at(i), dali_output.at(i))
+        numpy_batch = batch_to_array(numpy_output)
+        dali_batch = batch_to_array(dali_output)
+        if not numpy.array_equal(numpy_batch, dali_batch):
+            for numpy_image, dali_image in zip(numpy_batch, dali_batch):
+                if not numpy.array_equal(numpy_image, dali_image):
+                    cv2.imwrite("numpy.png", numpy_image)
+                    cv2.imwrite("dali.png", dali_image)
+                    assert numpy.array_equal(numpy_image, dali_image)
+
+
+def test_python_operator_transposed_output():
+    run_case(numpy.rot90)
 
 
 def test_python_operator_brightness():
@@ -300,8 +332,8 @@ def test_python_operator_brightness():
     for it in range(ITERS):
         numpy_output, = numpy_brightness.run()
         dali_output, = dali_brightness.run()
-        for i in range(len(dali_output)):
-            assert numpy.allclose(numpy_output.at(i), dali_output.as_cpu().at(i), rtol=1e-5, atol=1)
+        assert numpy.allclose(batch_to_array(numpy_output), batch_to_array(dali_output.as_cpu()),
+                              rtol=1e-5, atol=1)
 
 
 def invalid_function(image):
@@ -332,18 +364,16 @@ def mixed_types(image):
 
 
 def run_two_outputs(func):
-    pipe = BasicPipeline(BATCH_SIZE, NUM_WORKERS, DEVICE_ID, SEED, images_dir)
     pyfunc_pipe = TwoOutputsPythonOperatorPipeline(BATCH_SIZE, NUM_WORKERS, DEVICE_ID, SEED,
                                                    images_dir, func)
-    pipe.build()
     pyfunc_pipe.build()
-    for it in range(ITERS):
-        preprocessed_output, = pipe.run()
-        output1, output2 = pyfunc_pipe.run()
-        for i in range(len(output1)):
-            pro1, pro2 = func(preprocessed_output.at(i))
-            assert numpy.array_equal(output1.at(i), pro1)
-            assert numpy.array_equal(output2.at(i), pro2)
+    with ThreadPoolExecutor(NUM_WORKERS) as ref_pool:
+        for inputs, in reference_outputs(BasicPipeline):
+            expected = ref_pool.map(func, inputs)
+            output1, output2 = pyfunc_pipe.run()
+            pro1, pro2 = zip(*expected)
+            assert numpy.array_equal(batch_to_array(output1), numpy.stack(pro1))
+            assert numpy.array_equal(batch_to_array(output2), numpy.stack(pro2))
 
 
 def test_split():
@@ -354,44 +384,38 @@ def test_mixed_types():
     run_two_outputs(mixed_types)
 
 
-def multi_per_sample_compare(func, pipe, pyfunc_pipe):
-    for it in range(ITERS):
-        preprocessed_output1, preprocessed_output2 = pipe.run()
-        out1, out2, out3 = pyfunc_pipe.run()
-        for i in range(BATCH_SIZE):
-            pro1, pro2, pro3 = func(preprocessed_output1.at(i), preprocessed_output2.at(i))
-            assert numpy.array_equal(out1.at(i), pro1)
-            assert numpy.array_equal(out2.at(i), pro2)
-            assert numpy.array_equal(out3.at(i), pro3)
+def multi_per_sample_compare(func, ref_outputs, pyfunc_pipe):
+    with ThreadPoolExecutor(NUM_WORKERS) as ref_pool:
+        for in1, in2 in ref_outputs:
+            expected = ref_pool.map(func, in1, in2)
+            out1, out2, out3 = pyfunc_pipe.run()
+            pro1, pro2, pro3 = zip(*expected)
+            assert numpy.array_equal(batch_to_array(out1), numpy.stack(pro1))
+            assert numpy.array_equal(batch_to_array(out2), numpy.stack(pro2))
+            assert numpy.array_equal(batch_to_array(out3), numpy.stack(pro3))
 
 
-def multi_batch_compare(func, pipe, pyfunc_pipe):
-    for it in range(ITERS):
-        preprocessed_output1, preprocessed_output2 = pipe.run()
-        out1, out2, out3 = pyfunc_pipe.run()
-        in1 = [preprocessed_output1.at(i) for i in range(BATCH_SIZE)]
-        in2 = [preprocessed_output2.at(i) for i in range(BATCH_SIZE)]
-        pro1, pro2, pro3 = func(in1, in2)
-        for i in range(BATCH_SIZE):
-            assert numpy.array_equal(out1.at(i), pro1[i])
-            assert numpy.array_equal(out2.at(i), pro2[i])
-            assert numpy.array_equal(out3.at(i), pro3[i])
+def multi_batch_compare(func, ref_outputs, pyfunc_pipe):
+    with ThreadPoolExecutor(NUM_WORKERS) as ref_pool:
+        for in1, in2 in ref_outputs:
+            expected = ref_pool.submit(func, in1, in2)
+            out1, out2, out3 = pyfunc_pipe.run()
+            pro1, pro2, pro3 = expected.result()
+            assert numpy.array_equal(batch_to_array(out1), numpy.stack(pro1))
+            assert numpy.array_equal(batch_to_array(out2), numpy.stack(pro2))
+            assert numpy.array_equal(batch_to_array(out3), numpy.stack(pro3))
 
 
 def run_multi_input_multi_output(func, compare, batch=False):
-    pipe = DoubleLoadPipeline(BATCH_SIZE, NUM_WORKERS, DEVICE_ID, SEED, images_dir)
     pyfunc_pipe = MultiInputMultiOutputPipeline(BATCH_SIZE, NUM_WORKERS, DEVICE_ID, SEED,
                                                 images_dir, func, batch_processing=batch)
-    pipe.build()
     pyfunc_pipe.build()
-    compare(func, pipe, pyfunc_pipe)
+    compare(func, reference_outputs(DoubleLoadPipeline), pyfunc_pipe)
 
 
 def split_and_mix(images1, images2):
-    r = (images1[:, :, 0] + images2[:, :, 0]) // 2
-    g = (images1[:, :, 1] + images2[:, :, 1]) // 2
-    b = (images1[:, :, 2] + images2[:, :, 2]) // 2
-    return r, g, b
+    mixed = (images1 + images2) // 2
+    return mixed[:, :, 0], mixed[:, :, 1], mixed[:, :, 2]
 
 
 def output_with_stride_mixed_types(images1, images2):
@@ -471,7 +495,9 @@ SINK_PATH = tempfile.mkdtemp()
 
 
 def save(image):
-    Image.fromarray(image).save(SINK_PATH + '/sink_img' + str(time.process_time()) + '.jpg', 'JPEG')
+    written = cv2.imwrite(SINK_PATH + '/sink_img' + str(time.monotonic_ns()) + '.jpg',
+                          cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+    assert written, "Failed to write the sink image"
 
 
 def test_sink():
@@ -495,7 +521,7 @@ counter = 0
 def func_with_side_effects(images):
     global counter
     counter = counter + 1
-    return numpy.full_like(images, counter)
+    return numpy.broadcast_to(numpy.array(counter, dtype=images.dtype), images.shape)
 
 
 def test_func_with_side_effects():